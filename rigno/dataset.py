@@ -1,6 +1,9 @@
 """Utility functions for reading the datasets."""
 
 import h5py
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Union, Sequence, NamedTuple
@@ -14,6 +17,12 @@ import numpy as np
 from rigno.utils import Array, shuffle_arrays
 
 
+# HDF5 chunk cache of the opened datasets
+CHUNK_CACHE_NBYTES = 256 << 20
+CHUNK_CACHE_NSLOTS = 1_000_003
+# Maximum ratio of read to requested samples for reading a single block
+READ_BLOCK_MAX_RATIO = 2
+
 @dataclass
 class Metadata:
   periodic: bool
@@ -359,6 +368,10 @@ class Dataset:
     n_valid: int = 0,
     n_test: int = 0,
     preload: bool = False,
+    max_preload_bytes: int = (1 << 30),
+    block_size_mb: int = 8,
+    cache_path: str = None,
+    dtype: np.dtype = None,
     key: flax.typing.PRNGKey = None,
   ):
 
@@ -371,6 +384,8 @@ class Dataset:
     self.time_downsample_factor = time_downsample_factor
     self.unstructured = unstructured
     self.space_downsample_factor = space_downsample_factor
+    # NOTE: Trajectories, coefficients, and coordinates are cast to dtype on read
+    self.dtype = dtype
 
     # Modify metadata
     if not include_passive_variables:
@@ -383,13 +398,31 @@ class Dataset:
     # Set data attributes
     self.data_group = self.metadata.data_group
     self.coeff_group = self.metadata.coeff_group
-    self.reader = h5py.File(Path(datadir) / f'{datapath}.nc', 'r')
+    # NOTE: The file is opened lazily, once per process
+    self._path = (str(cache_path) if (cache_path is not None)
+      else f'{str(datadir).rstrip("/")}/{datapath}.nc')
+    self._block_size = (block_size_mb << 20)
+    self._handles = None
+    self._handles_pid = None
+    # NOTE: Materialized files are already in the layout of the batches
+    self._canonical = bool(self.reader.attrs.get('canonical', False))
+    if self._canonical:
+      assert self.reader.attrs['include_passive_variables'] == include_passive_variables
     self.idx_vars = (None if include_passive_variables
       else self.metadata.active_variables)
     self.data = None
     self.coeff = None
+
+    # Preload the data if it fits in memory
+    _sample_nbytes = self._dset.dtype.itemsize * np.prod(self._dset.shape[1:])
+    if self._coeff_dset is not None:
+      _sample_nbytes += self._coeff_dset.dtype.itemsize * np.prod(self._coeff_dset.shape[1:])
+    _nbytes = (n_train + n_valid + n_test) * _sample_nbytes
+    if 0 < _nbytes <= max_preload_bytes:
+      self.preload = True
+
     self.length = ((n_train + n_valid + n_test) if self.preload
-      else self.reader[self.data_group].shape[0])
+      else self._dset.shape[0])
     self.sample = self._fetch(0)
     self.shape = self.sample.shape
     if self.time_dependent:
@@ -405,11 +438,11 @@ class Dataset:
     self.nums = {'train': n_train, 'valid': n_valid, 'test': n_test}
     self.idx_modes = {
       # First n_train samples
-      'train': jax.random.permutation(self.key, n_train),
+      'train': np.asarray(jax.random.permutation(self.key, n_train), dtype=np.int64),
       # First n_valid samples after the training samples
-      'valid': np.arange(n_train, (n_train + n_valid)),
+      'valid': np.arange(n_train, (n_train + n_valid), dtype=np.int64),
       # Last n_test samples
-      'test': np.arange((self.length - n_test), self.length),
+      'test': np.arange((self.length - n_test), self.length, dtype=np.int64),
     }
 
     # Instantiate the dataset stats
@@ -432,16 +465,16 @@ class Dataset:
 
     # Load the data
     if self.preload:
-      _len_dataset = self.reader[self.data_group].shape[0]
-      train_data = self.reader[self.data_group][np.arange(n_train)]
-      valid_data = self.reader[self.data_group][np.arange(n_train, (n_train + n_valid))]
-      test_data = self.reader[self.data_group][np.arange((_len_dataset - n_test), (_len_dataset))]
-      self.data = np.concatenate([train_data, valid_data, test_data], axis=0)
+      _len_dataset = self._dset.shape[0]
+      train_data = self._dset[:n_train]
+      valid_data = self._dset[n_train:(n_train + n_valid)]
+      test_data = self._dset[(_len_dataset - n_test):_len_dataset]
+      self.data = np.concatenate([train_data, valid_data, test_data], axis=0, dtype=self.dtype)
       if self.coeff_group is not None:
-        train_coeff = self.reader[self.coeff_group][np.arange(n_train)]
-        valid_coeff = self.reader[self.coeff_group][np.arange(n_train, (n_train + n_valid))]
-        test_coeff = self.reader[self.coeff_group][np.arange((_len_dataset - n_test), (_len_dataset))]
-        self.coeff = np.concatenate([train_coeff, valid_coeff, test_coeff], axis=0)
+        train_coeff = self._coeff_dset[:n_train]
+        valid_coeff = self._coeff_dset[n_train:(n_train + n_valid)]
+        test_coeff = self._coeff_dset[(_len_dataset - n_test):_len_dataset]
+        self.coeff = np.concatenate([train_coeff, valid_coeff, test_coeff], axis=0, dtype=self.dtype)
 
   @property
   def time_dependent(self):
@@ -456,30 +489,163 @@ class Dataset:
     # Get all trajectories
     batch = self.train(np.arange(self.nums['train']))
     u, c, _, t = batch.unravel()
+    # NOTE: Statistics are computed in single precision and cast to the dataset dtype
+    dtype = u.dtype
+    u = u.astype(np.float32)
+    c = c.astype(np.float32) if (c is not None) else None
+
+    # Single-pass moments (float64 sums and squared sums)
+    _sum = lambda arr: np.sum(arr, axis=(0, 1, 2), keepdims=True, dtype=np.float64)
+    def _moments(count, sum, sumsq, dtype):
+      mean = sum / count
+      std = np.sqrt(np.maximum(sumsq / count - mean ** 2, 0))
+      return mean.astype(dtype), std.astype(dtype)
 
     # Compute statistics of solutions and coefficients
-    self.stats['u']['mean'] = np.mean(u, axis=(0, 1, 2), keepdims=True)
-    self.stats['u']['std'] = np.std(u, axis=(0, 1, 2), keepdims=True)
+    self.stats['u']['mean'], self.stats['u']['std'] = _moments(
+      np.prod(u.shape[:3]), _sum(u), _sum(u ** 2), dtype)
     if c is not None:
-      self.stats['c']['mean'] = np.mean(c, axis=(0, 1, 2), keepdims=True)
-      self.stats['c']['std'] = np.std(c, axis=(0, 1, 2), keepdims=True)
+      self.stats['c']['mean'], self.stats['c']['std'] = _moments(
+        np.prod(c.shape[:3]), _sum(c), _sum(c ** 2), dtype)
 
     # Compute statistics of the residuals and time derivatives
-    if self.time_dependent:
+    # NOTE: Moments are accumulated per lag to avoid concatenating all lags
+    # NOTE: With a fixed dt, the derivatives of lag s are the residuals over s * dt
+    if self.time_dependent and residual_steps > 0:
       _get_res = lambda s, trj: (trj[:, (s):] - trj[:, :-(s)])
-      residuals = []
-      derivatives = []
+      count = 0
+      res_sum = res_sumsq = der_sum = der_sumsq = 0.
       for s in range(1, residual_steps+1):
         res = _get_res(s, u)
-        tau = _get_res(s, t)
-        residuals.append(res)
-        derivatives.append(res / tau)
-      residuals = np.concatenate(residuals, axis=1)
-      derivatives = np.concatenate(derivatives, axis=1)
-      self.stats['res']['mean'] = np.mean(residuals, axis=(0, 1, 2), keepdims=True)
-      self.stats['res']['std'] = np.std(residuals, axis=(0, 1, 2), keepdims=True)
-      self.stats['der']['mean'] = np.mean(derivatives, axis=(0, 1, 2), keepdims=True)
-      self.stats['der']['std'] = np.std(derivatives, axis=(0, 1, 2), keepdims=True)
+        tau = s * self.dt
+        _res_sum = _sum(res)
+        _res_sumsq = _sum(res ** 2)
+        count += np.prod(res.shape[:3])
+        res_sum += _res_sum
+        res_sumsq += _res_sumsq
+        der_sum += _res_sum / tau
+        der_sumsq += _res_sumsq / (tau ** 2)
+      self.stats['res']['mean'], self.stats['res']['std'] = _moments(
+        count, res_sum, res_sumsq, dtype)
+      self.stats['der']['mean'], self.stats['der']['std'] = _moments(
+        count, der_sum, der_sumsq, dtype)
+
+  @staticmethod
+  def _open(path: str, block_size: int) -> h5py.File:
+    """
+    Opens an HDF5 file for reading.
+
+    Remote files (e.g., s3://) are wrapped in a block-cached file object so
+    that the small reads of h5py coalesce into requests of block_size bytes.
+    """
+
+    if '://' in path:
+      import fsspec
+      file = fsspec.open(path, mode='rb', cache_type='mmap', block_size=block_size).open()
+      return h5py.File(file, 'r',
+        rdcc_nbytes=CHUNK_CACHE_NBYTES, rdcc_nslots=CHUNK_CACHE_NSLOTS)
+
+    return h5py.File(Path(path), 'r',
+      rdcc_nbytes=CHUNK_CACHE_NBYTES, rdcc_nslots=CHUNK_CACHE_NSLOTS)
+
+  def _get_handles(self) -> tuple:
+    """
+    Returns the HDF5 file and its data and coefficient datasets.
+    The handles are opened once per process, so that forked workers never
+    share the handles of their parent.
+    """
+
+    if self._handles_pid != os.getpid():
+      reader = self._open(self._path, block_size=self._block_size)
+      dset = reader[self.data_group]
+      coeff_dset = reader[self.coeff_group] if (self.coeff_group is not None) else None
+      self._handles = (reader, dset, coeff_dset)
+      self._handles_pid = os.getpid()
+
+    return self._handles
+
+  @property
+  def reader(self) -> h5py.File:
+    return self._get_handles()[0]
+
+  @property
+  def _dset(self) -> h5py.Dataset:
+    return self._get_handles()[1]
+
+  @property
+  def _coeff_dset(self) -> h5py.Dataset:
+    return self._get_handles()[2]
+
+  @staticmethod
+  def _read(dset: h5py.Dataset, idx: np.ndarray) -> np.ndarray:
+    """
+    Reads the samples of a dataset with few hyperslab reads.
+
+    Fancy indexing an HDF5 dataset issues one read per index. Instead, the
+    contiguous block spanning all the indices is read at once if it is dense
+    enough, otherwise each run of consecutive indices is read at once. The
+    samples are gathered in memory and follow the order of the indices.
+    """
+
+    idx_unique, idx_inverse = np.unique(idx, return_inverse=True)
+    lo, hi = int(idx_unique[0]), int(idx_unique[-1]) + 1
+    if (hi - lo) <= READ_BLOCK_MAX_RATIO * len(idx_unique):
+      block = dset[lo:hi]
+      return block[idx - lo]
+
+    # NOTE: Only the requested samples are held in memory (e.g., shuffled batches)
+    runs = np.split(idx_unique, np.flatnonzero(np.diff(idx_unique) > 1) + 1)
+    block = np.concatenate([dset[int(run[0]):(int(run[-1]) + 1)] for run in runs], axis=0)
+
+    return block[idx_inverse]
+
+  def _canonicalize(self, u: np.ndarray) -> np.ndarray:
+    """Brings raw trajectories to the layout [N, T, X, Y, C] and selects the variables."""
+
+    if self._canonical:
+      return u
+
+    # NOTE: Variables are selected before moving the axes to copy less data
+    if len(u.shape) == 5:  # NOTE: Multi-variable datasets
+      if self.idx_vars is not None:
+        u = u[:, :, self.idx_vars]
+      u = np.moveaxis(u, source=(2, 3, 4), destination=(4, 2, 3))
+    else:
+      if len(u.shape) == 4:  # NOTE: Single-variable datasets
+        u = np.expand_dims(u, axis=-1)
+      elif len(u.shape) == 3:  # NOTE: Single-variable time-independent datasets
+        u = np.expand_dims(u, axis=(1, -1))
+      if self.idx_vars is not None:
+        u = u[..., self.idx_vars]
+
+    return u
+
+  def materialize_transposed(self, cache_path: str, num_samples_per_write: int = 16) -> None:
+    """
+    Writes the dataset in the layout of the batches to a new HDF5 file.
+
+    The trajectories are stored as [N, T, X, Y, C] with the selected variables,
+    chunked by sample. Datasets created with cache_path pointing to this file
+    skip the transposition and the selection of the variables in _fetch.
+    """
+
+    num_samples = self._dset.shape[0]
+    sample = self._canonicalize(self._dset[:1])
+    with h5py.File(cache_path, 'w') as writer:
+      dset = writer.create_dataset(self.data_group,
+        shape=(num_samples, *sample.shape[1:]), dtype=sample.dtype,
+        chunks=(1, *sample.shape[1:]), compression='lzf')
+      for i in range(0, num_samples, num_samples_per_write):
+        dset[i:(i+num_samples_per_write)] = np.ascontiguousarray(
+          self._canonicalize(self._dset[i:(i+num_samples_per_write)]))
+      if self._coeff_dset is not None:
+        coeff_dset = writer.create_dataset(self.coeff_group,
+          shape=self._coeff_dset.shape, dtype=self._coeff_dset.dtype,
+          chunks=(1, *self._coeff_dset.shape[1:]), compression='lzf')
+        for i in range(0, num_samples, num_samples_per_write):
+          coeff_dset[i:(i+num_samples_per_write)] = self._coeff_dset[i:(i+num_samples_per_write)]
+      writer.attrs['canonical'] = True
+      writer.attrs['include_passive_variables'] = (self.idx_vars is None)
 
   def _fetch(self, idx: Union[int, Sequence]) -> Batch:
     """Fetches a sample from the dataset, given its global index."""
@@ -487,34 +653,32 @@ class Dataset:
     # Check inputs
     if isinstance(idx, int):
       idx = [idx]
+    idx = np.asarray(idx)
 
     # Get trajectories
     if self.data is not None:
-      u = self.data[np.sort(idx)]
+      u = self.data[idx]
     else:
-      u = self.reader[self.data_group][np.sort(idx)]
-
-    # Move axes
-    if len(u.shape) == 5:  # NOTE: Multi-variable datasets
-      u = np.moveaxis(u, source=(2, 3, 4), destination=(4, 2, 3))
-    elif len(u.shape) == 4:  # NOTE: Single-variable datasets
-      u = np.expand_dims(u, axis=-1)
-    elif len(u.shape) == 3:  # NOTE: Single-variable time-independent datasets
-      u = np.expand_dims(u, axis=(1, -1))
+      u = self._read(self._dset, idx)
 
-    # Select variables
-    if self.idx_vars is not None:
-      u = u[..., self.idx_vars]
+    # Select variables and move axes
+    u = self._canonicalize(u)
+    if self.dtype is not None:
+      u = u.astype(self.dtype, copy=False)
 
     # Read coefficients
     if self.coeff_group is not None:
       # Get the coefficients
       if self.coeff is not None:
-        c = self.coeff[np.sort(idx)]
+        c = self.coeff[idx]
       else:
-        c = self.reader[self.coeff_group][np.sort(idx)]
+        c = self._read(self._coeff_dset, idx)
+      if self.dtype is not None:
+        c = c.astype(self.dtype, copy=False)
       c = np.expand_dims(c, axis=(1, 4))
-      c = np.tile(c, reps=(1, u.shape[1], 1, 1, 1))
+      # Repeat along the time axis
+      # NOTE: Read-only view, no copies are made
+      c = np.broadcast_to(c, shape=(c.shape[0], u.shape[1], *c.shape[2:]))
     else:
       c = None
 
@@ -533,8 +697,11 @@ class Dataset:
     _y = _y.reshape(1, 1, -1, 1)
     # Concatenate the coordinates
     x = np.concatenate([_x, _y], axis=3)
+    if self.dtype is not None:
+      x = x.astype(self.dtype, copy=False)
     # Repeat along sample and time axes
-    x = np.tile(x, reps=(u.shape[0], u.shape[1], 1, 1))
+    # NOTE: Read-only views, no copies are made
+    x = np.broadcast_to(x, shape=(u.shape[0], u.shape[1], *x.shape[2:]))
     # Flatten the trajectory
     u = u.reshape(u.shape[0], u.shape[1], (u.shape[2] * u.shape[3]), -1)
     if c is not None:
@@ -544,8 +711,10 @@ class Dataset:
     if self.metadata.domain_t is not None:
       t = np.linspace(*self.metadata.domain_t, u.shape[1], endpoint=True)
       t = t.reshape(1, -1, 1, 1)
+      if self.dtype is not None:
+        t = t.astype(self.dtype, copy=False)
       # Repeat along sample trajectory
-      t = np.tile(t, reps=(u.shape[0], 1, 1, 1))
+      t = np.broadcast_to(t, shape=(u.shape[0], *t.shape[1:]))
     else:
       t = None
 
@@ -589,8 +758,9 @@ class Dataset:
     if isinstance(idx, int):
       idx = [idx]
     # Set mode index
-    assert all([i < len(self.idx_modes[mode]) for i in idx])
-    _idx = self.idx_modes[mode][np.array(idx)]
+    idx = np.asarray(idx, dtype=np.int64)
+    assert np.all(idx < len(self.idx_modes[mode]))
+    _idx = self.idx_modes[mode][idx]
 
     return self._fetch(_idx)
 
@@ -603,24 +773,52 @@ class Dataset:
   def test(self, idx: Union[int, Sequence]):
     return self._fetch_mode(idx, mode='test')
 
-  def batches(self, mode: str, batch_size: int, key: flax.typing.PRNGKey = None):
+  def batches(self,
+    mode: str,
+    batch_size: int,
+    key: flax.typing.PRNGKey = None,
+    prefetch: int = 0,
+  ):
+    """
+    Yields the batches of a split of the dataset.
+
+    If prefetch is positive, the next prefetch batches are fetched in
+    background threads while the current batch is being consumed.
+    """
+
     assert batch_size > 0
     assert batch_size <= self.nums[mode]
 
     if key is not None:
-      _idx_mode_permuted = jax.random.permutation(key, np.arange(self.nums[mode]))
+      _idx_mode_permuted = np.asarray(jax.random.permutation(key, self.nums[mode]), dtype=np.int64)
     else:
-      _idx_mode_permuted = jnp.arange(self.nums[mode])
+      _idx_mode_permuted = np.arange(self.nums[mode], dtype=np.int64)
 
     len_dividable = self.nums[mode] - (self.nums[mode] % batch_size)
-    for idx in np.split(_idx_mode_permuted[:len_dividable], len_dividable // batch_size):
-      batch = self._fetch_mode(idx, mode)
-      yield batch
-
+    # NOTE: Rows of a reshaped view, no list of split copies is made
+    idx_batches = list(_idx_mode_permuted[:len_dividable].reshape(-1, batch_size))
     if (self.nums[mode] % batch_size):
-      idx = _idx_mode_permuted[len_dividable:]
-      batch = self._fetch_mode(idx, mode)
-      yield batch
+      idx_batches.append(_idx_mode_permuted[len_dividable:])
+
+    if not prefetch:
+      for idx in idx_batches:
+        yield self._fetch_mode(idx, mode)
+      return
+
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    futures = deque()
+    try:
+      for idx in idx_batches:
+        futures.append(executor.submit(self._fetch_mode, idx, mode))
+        if len(futures) > prefetch:
+          yield futures.popleft().result()
+      while futures:
+        yield futures.popleft().result()
+    finally:
+      # NOTE: Does not wait for the pending reads if the generator is closed early
+      for future in futures:
+        future.cancel()
+      executor.shutdown(wait=False, cancel_futures=True)
 
   def __len__(self):
     return self.length
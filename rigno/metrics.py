@@ -63,6 +63,12 @@ def lp_norm(arr: Array, p: int = 2, axis: Union[None, Sequence[int]] = None) ->
     if axis is None:
         axis = (1, 2, 3)
 
+    # NOTE: Fast paths without the generic power kernels
+    if p == 1:
+        return jnp.sum(jnp.abs(arr), axis=axis)
+    if p == 2:
+        return jnp.sqrt(jnp.sum(jnp.square(arr), axis=axis))
+
     # Sum on timespace (quadrature) and variables
     abs_pow_sum = jnp.sum(jnp.power(jnp.abs(arr), p), axis=axis)
     # Take the p-th root
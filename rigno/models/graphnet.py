@@ -30,6 +30,7 @@ from typing import Mapping, Optional, Union
 import jax
 import jax.numpy as jnp
 import flax.linen as nn
+import flax.typing
 import jraph
 
 from rigno.graph.typed_graph import TypedGraph
@@ -94,6 +95,10 @@ class DeepTypedGraphNet(nn.Module):
       increase the number of edges connected to a node. In particular, this is
       useful when using segment_sum, but should not be combined with
       segment_mean.
+    remat_message_passing: If True, the activations of each message passing
+      step are rematerialized in the backward pass instead of being stored.
+    dtype: The dtype of the computations of all MLPs, parameters are always
+      kept in float32. Defaults to the dtype of the inputs.
     name: Name of the model.
 
   """
@@ -116,6 +121,8 @@ class DeepTypedGraphNet(nn.Module):
   f32_aggregation: bool = False
   aggregate_edges_for_nodes_fn: str = 'segment_mean'
   aggregate_normalization: Optional[float] = None
+  remat_message_passing: bool = False
+  dtype: Optional[flax.typing.Dtype] = None
 
   def setup(self):
     self._activation = _get_activation_fn(self.activation)
@@ -135,6 +142,7 @@ class DeepTypedGraphNet(nn.Module):
           activation=self._activation,
           use_layer_norm=self.use_layer_norm,
           use_conditional_norm=False,
+          dtype=self.dtype,
           name=f'encoder_edges_{edge_set_name}',
         )
         for edge_set_name in self.edge_latent_size.keys()
@@ -151,6 +159,7 @@ class DeepTypedGraphNet(nn.Module):
           activation=self._activation,
           use_layer_norm=self.use_layer_norm,
           use_conditional_norm=False,
+          dtype=self.dtype,
           name=f'encoder_nodes_{node_set_name}',
         )
         for node_set_name in self.node_latent_size.keys()
@@ -196,6 +205,7 @@ class DeepTypedGraphNet(nn.Module):
             use_layer_norm=self.use_layer_norm,
             use_conditional_norm=self.conditioned_normalization,
             cond_norm_hidden_size=self.cond_norm_hidden_size,
+            dtype=self.dtype,
             name=f'processor_{step_i}_edges_{edge_set_name}',
           )
           for edge_set_name in self.edge_latent_size.keys()
@@ -210,6 +220,7 @@ class DeepTypedGraphNet(nn.Module):
             use_layer_norm=self.use_layer_norm,
             use_conditional_norm=self.conditioned_normalization,
             cond_norm_hidden_size=self.cond_norm_hidden_size,
+            dtype=self.dtype,
             name=f'processor_{step_i}_nodes_{node_set_name}',
           )
           for node_set_name in self.node_latent_size.keys()
@@ -231,6 +242,7 @@ class DeepTypedGraphNet(nn.Module):
           activation=self._activation,
           use_layer_norm=False,
           use_conditional_norm=False,
+          dtype=self.dtype,
           name=f'decoder_edges_{edge_set_name}',
         )
         for edge_set_name in self.edge_output_size.keys()
@@ -244,6 +256,7 @@ class DeepTypedGraphNet(nn.Module):
           activation=self._activation,
           use_layer_norm=False,
           use_conditional_norm=False,
+          dtype=self.dtype,
           name=f'decoder_nodes_{node_set_name}',
         )
         for node_set_name in self.node_output_size.keys()
@@ -288,24 +301,29 @@ class DeepTypedGraphNet(nn.Module):
     latent_graph_0 = self._embedder_network(input_graph, **kwargs)
     return latent_graph_0
 
-  def _process(self, latent_graph_0: TypedGraph, **kwargs) -> TypedGraph:
+  def _process(self, latent_graph_0: TypedGraph, c: Union[None, float] = None) -> TypedGraph:
     """Processes the latent graph with several steps of message passing."""
 
     # Do `num_message_passing_steps` with each of the `self._processor_networks`
     # with unshared weights, and repeat that `self._num_processor_repetitions`
     # times.
+    # NOTE: The index of the step is static (self counts as argument 0).
+    process_step = DeepTypedGraphNet._process_step
+    if self.remat_message_passing:
+      process_step = nn.remat(process_step, static_argnums=(1,))
     latent_graph = latent_graph_0
     for _ in range(self.num_processor_repetitions):
-      for processor_network in self._processor_networks:
-        latent_graph = self._process_step(processor_network, latent_graph, **kwargs)
+      for step_i in range(len(self._processor_networks)):
+        latent_graph = process_step(self, step_i, latent_graph, c)
 
     return latent_graph
 
-  def _process_step(self, processor_network_k, latent_graph_prev_k: TypedGraph, **kwargs) -> TypedGraph:
+  def _process_step(self, step_i: int, latent_graph_prev_k: TypedGraph, c) -> TypedGraph:
     """Single step of message passing with node/edge residual connections."""
 
     # One step of message passing.
-    latent_graph_k = processor_network_k(latent_graph_prev_k, **kwargs)
+    processor_network_k = self._processor_networks[step_i]
+    latent_graph_k = processor_network_k(latent_graph_prev_k, c=c)
 
     # Add residuals.
     nodes_with_residuals = {}
@@ -327,14 +327,13 @@ class RegionInteractionGraphBuilder:
         rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
         assert cols.shape == rows.shape
         _extended_edges = np.stack([rows, cols], -1) # [e,2]
-        domain = _extended_edges // _rmesh_size # [e,2]
-        edge   = _extended_edges % _rmesh_size # [e,2]
+        domain, edge = np.divmod(_extended_edges, _rmesh_size) # [e,2], [e,2]
         is_row_0 = domain[:,0] == 0
         is_col_0 = domain[:,1] == 0
         is_all_0 = is_row_0 & is_col_0
         is_any_0 = is_row_0 | is_col_0 
         mask     = is_any_0 if self.periodic else is_all_0 # [e]
-        edge     = (edge[:,0] << 32) & edge[:, 1]
+        edge     = (edge[:,0] << 32) | edge[:, 1]
         edge, index = np.unique(edge[mask], axis=0, return_index=True)
         edge     = np.stack([edge >> 32, edge & 0xFFFFFFFF], -1)
         domain  = domain[mask][index]
@@ -531,6 +530,7 @@ class Encoder(nn.Module):
   conditioned_normalization: bool = True
   cond_norm_hidden_size: bool = True
   p_edge_masking: float = .0
+  dtype: Union[None, flax.typing.Dtype] = None
 
   def setup(self):
     self.gnn = DeepTypedGraphNet(
@@ -549,6 +549,7 @@ class Encoder(nn.Module):
       f32_aggregation=True,
       aggregate_edges_for_nodes_fn='segment_mean',
       aggregate_normalization=None,
+      dtype=self.dtype,
     )
 
   def __call__(self,
@@ -639,6 +640,8 @@ class Processor(nn.Module):
   conditioned_normalization: bool = True
   cond_norm_hidden_size: bool = True
   p_edge_masking: float = .0
+  dtype: Union[None, flax.typing.Dtype] = None
+  remat_steps: bool = False
 
   def setup(self):
     self.gnn = DeepTypedGraphNet(
@@ -657,6 +660,8 @@ class Processor(nn.Module):
       f32_aggregation=False,
       # NOTE: segment_mean because number of edges is not balanced
       aggregate_edges_for_nodes_fn='segment_mean',
+      remat_message_passing=self.remat_steps,
+      dtype=self.dtype,
     )
 
   def __call__(self,
@@ -735,6 +740,7 @@ class Decoder(nn.Module):
   conditioned_normalization: bool = True
   cond_norm_hidden_size: bool = True
   p_edge_masking: float = .0
+  dtype: Union[None, flax.typing.Dtype] = None
 
   def setup(self):
     self.gnn = DeepTypedGraphNet(
@@ -757,6 +763,7 @@ class Decoder(nn.Module):
     f32_aggregation=False,
     # NOTE: segment_mean because number of edges is not balanced
     aggregate_edges_for_nodes_fn='segment_mean',
+    dtype=self.dtype,
   )
 
   def __call__(self,
@@ -842,6 +849,8 @@ class RIGNO(AbstractOperator):
   conditioned_normalization: bool = True
   cond_norm_hidden_size: int = 16
   p_edge_masking: int = 0.5
+  remat_processor: bool = False
+  compute_dtype: Union[None, str] = None
 
   def _check_coordinates(self, x: Array) -> None:
     assert x is not None
@@ -861,6 +870,8 @@ class RIGNO(AbstractOperator):
     # NOTE: variable_mesh=True means that the input and the output mesh can be different
     # NOTE: Check usages of this attribute
     self.variable_mesh = False
+    # NOTE: Parameters are always stored in float32
+    self.dtype = (jnp.dtype(self.compute_dtype) if self.compute_dtype else None)
 
     self.encoder = Encoder(
       edge_latent_size=self.edge_latent_size,
@@ -870,6 +881,7 @@ class RIGNO(AbstractOperator):
       conditioned_normalization=self.conditioned_normalization,
       cond_norm_hidden_size=self.cond_norm_hidden_size,
       p_edge_masking=self.p_edge_masking,
+      dtype=self.dtype,
       name='encoder',
     )
 
@@ -882,6 +894,8 @@ class RIGNO(AbstractOperator):
       conditioned_normalization=self.conditioned_normalization,
       cond_norm_hidden_size=self.cond_norm_hidden_size,
       p_edge_masking=self.p_edge_masking,
+      remat_steps=self.remat_processor,
+      dtype=self.dtype,
       name='processor',
     )
 
@@ -895,6 +909,7 @@ class RIGNO(AbstractOperator):
       conditioned_normalization=self.conditioned_normalization,
       cond_norm_hidden_size=self.cond_norm_hidden_size,
       p_edge_masking=self.p_edge_masking,
+      dtype=self.dtype,
       name='decoder',
     )
 
@@ -1011,6 +1026,7 @@ class RIGNO(AbstractOperator):
     # Reshape the output to [batch_size, 1, num_pnodes_out, num_outputs]
     # [num_pnodes_out, batch_size, num_outputs] -> u
     output = self._reorder_features(output_pnodes, num_pnodes_out)
+    output = output.astype(inputs.u.dtype)
     self._check_function(output, x=inputs.x_out)
 
     return output
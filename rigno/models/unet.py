@@ -10,6 +10,15 @@ from rigno.models.utils import ConditionedNorm
 from rigno.utils import Array
 
 
+def _avg_pool(x: Array, r: int = 2) -> Array:
+  """Averages non-overlapping r x r windows of the spatial axes [..., X, Y, C]."""
+
+  *lead, nx, ny, nc = x.shape
+  x = x[..., :(nx // r * r), :(ny // r * r), :]
+  x = x.reshape(*lead, (nx // r), r, (ny // r), r, nc)
+
+  return x.mean(axis=(-4, -2))
+
 class Encoder(nn.Module):
   features: int
   cond_norm_hidden_size: int
@@ -26,7 +35,7 @@ class Encoder(nn.Module):
       convolutional=True,
     )(tau, z1)
     z1 = nn.swish(z1)
-    z1_pool = nn.avg_pool(z1, window_shape=(2, 2), strides=(2, 2))
+    z1_pool = _avg_pool(z1, r=2)
 
     z2 = nn.Conv(self.features * 4, kernel_size=(3, 3))(z1_pool)
     z2 = nn.swish(z2)
@@ -38,7 +47,7 @@ class Encoder(nn.Module):
       convolutional=True,
     )(tau, z2)
     z2 = nn.swish(z2)
-    z2_pool = nn.avg_pool(z2, window_shape=(2, 2), strides=(2, 2))
+    z2_pool = _avg_pool(z2, r=2)
 
     z3 = nn.Conv(self.features * 8, kernel_size=(3, 3))(z2_pool)
     z3 = nn.swish(z3)
@@ -52,7 +61,7 @@ class Encoder(nn.Module):
     z3 = nn.swish(z3)
     # z3_dropout = nn.Dropout(0.5, deterministic=False)(z3)
     z3_dropout = z3
-    z3_pool = nn.avg_pool(z3_dropout, window_shape=(2, 2), strides=(2, 2))
+    z3_pool = _avg_pool(z3_dropout, r=2)
 
     z4 = nn.Conv(self.features * 16, kernel_size=(3, 3))(z3_pool)
     z4 = nn.swish(z4)
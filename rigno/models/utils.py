@@ -1,8 +1,9 @@
 """A library of auxiliary functions and classes."""
 
-from typing import Sequence, Callable
+from typing import Sequence, Callable, Optional
 
 import flax.linen as nn
+import flax.typing
 import jax.numpy as jnp
 import jax.tree_util as tree
 
@@ -10,7 +11,12 @@ from rigno.utils import Array, calculate_fd_derivative
 
 
 def concatenate_args(args, kwargs, axis: int = -1):
+  # Bypass flattening and concatenation for a single array
+  if (len(args) == 1) and (not kwargs) and isinstance(args[0], Array):
+    return args[0]
   combined_args = tree.tree_flatten(args)[0] + tree.tree_flatten(kwargs)[0]
+  if len(combined_args) == 1:
+    return combined_args[0]
   concat_args = jnp.concatenate(combined_args, axis=axis)
   return concat_args
 
@@ -46,38 +52,37 @@ class AugmentedMLP(nn.Module):
   use_conditional_norm: bool = False
   cond_norm_hidden_size: int = 4
   concatenate_axis: int = -1
+  dtype: Optional[flax.typing.Dtype] = None
 
-  def setup(self):
-    # Set up layers
-    self.layers = [nn.Dense(features) for features in self.layer_sizes]
-
-    # Set up normalization layer
-    self.layernorm = nn.LayerNorm(
-      reduction_axes=-1,
-      feature_axes=-1,
-      use_scale=True,
-      use_bias=True,
-    ) if self.use_layer_norm else None
-
-    # Set conditional normalization layer
-    self.correction = None
-    if self.use_conditional_norm:
-      self.correction = ConditionedNorm(
-        latent_size=self.cond_norm_hidden_size,
-        correction_size=self.layer_sizes[-1],
-      )
-
+  @nn.compact
   def __call__(self, *args, c = None, **kwargs):
+    # NOTE: Submodule names match the former setup attributes (checkpoint compatible)
     x = concatenate_args(args=args, kwargs=kwargs, axis=self.concatenate_axis)
-    for layer in self.layers[:-1]:
-      x = layer(x)
+    for i, features in enumerate(self.layer_sizes[:-1]):
+      x = nn.Dense(features, dtype=self.dtype, name=f'layers_{i}')(x)
       x = self.activation(x)
-    x = self.layers[-1](x)
-    if self.layernorm:
-      x = self.layernorm(x)
-    if self.correction:
+    x = nn.Dense(self.layer_sizes[-1], dtype=self.dtype, name=f'layers_{len(self.layer_sizes)-1}')(x)
+
+    # Apply normalization layer
+    if self.use_layer_norm:
+      x = nn.LayerNorm(
+        reduction_axes=-1,
+        feature_axes=-1,
+        use_scale=True,
+        use_bias=True,
+        dtype=self.dtype,
+        name='layernorm',
+      )(x)
+
+    # Apply conditional normalization layer
+    if self.use_conditional_norm:
       assert c is not None
-      x = self.correction(c=c, x=x)
+      x = ConditionedNorm(
+        latent_size=self.cond_norm_hidden_size,
+        correction_size=self.layer_sizes[-1],
+        name='correction',
+      )(c=c, x=x)
+
     return x
 
 class ConditionedNorm(nn.Module):
@@ -4,10 +4,14 @@ from typing import Union
 import flax.typing
 import jax
 import jax.numpy as jnp
+import numpy as np
 
 from rigno.models.operator import AbstractOperator, Inputs
 from rigno.utils import Array, is_multiple, normalize, unnormalize
 
+# Maximum number of loop steps that are fully unrolled at compile time
+UNROLL_MAX_STEPS = 4
+
 class Stepper(ABC):
 
   def __init__(self, operator: AbstractOperator):
@@ -95,8 +99,10 @@ class Stepper(ABC):
     tau_fract = tau_tiled / num_steps
     forcing = tau_fract
 
+    # NOTE: num_steps is static, short loops are unrolled
     (u_out, _), _ = jax.lax.scan(f=scan_fn_fractional,
-      init=(inputs.u, inputs.t), xs=forcing, length=num_steps)
+      init=(inputs.u, inputs.t), xs=forcing, length=num_steps,
+      unroll=(num_steps if (num_steps <= UNROLL_MAX_STEPS) else 1))
 
     return u_out
 
@@ -343,9 +349,18 @@ class OutputStepper(Stepper):
 
     return (u_tgt_nrm, u_prd_nrm)
 
+# Minimum number of autoregressive steps for rematerializing the rollouts
+REMAT_MIN_STEPS = 8
+
 class AutoregressiveStepper:
 
-  def __init__(self, stepper: Stepper, dt: float, tau_max: Union[None, float] = None):
+  def __init__(self,
+    stepper: Stepper,
+    dt: float,
+    tau_max: Union[None, float] = None,
+    unroll_direct: Union[None, bool] = None,
+    remat: Union[None, bool] = None,
+  ):
     """
     Class for autoregressive inferrence of an operator.
 
@@ -353,6 +368,11 @@ class AutoregressiveStepper:
         stepper: Uses an operator with proper stepping method.
         dt: Time resolution of the trajectory.
         tau_max: Maximum time difference of direct predictions. Defaults to None.
+        unroll_direct: If True, the loop over direct predictions is unrolled.
+          Defaults to None, which unrolls it only for few direct predictions.
+        remat: If True, the body of the autoregressive loop is rematerialized
+          in the backward pass. Defaults to None, which rematerializes it
+          only for rollouts of at least REMAT_MIN_STEPS steps.
     """
 
     if tau_max is None:
@@ -361,14 +381,33 @@ class AutoregressiveStepper:
     if tau_max >= dt:
       assert is_multiple(tau_max, dt)
       self.num_steps_direct = int(tau_max / dt)
-      self._apply_operator = jax.checkpoint(stepper.apply)
+      self._apply_operator = stepper.apply
     else:
       assert is_multiple(dt, tau_max)
       self.num_steps_direct = 1
       num_unrolls_per_step = int(dt / tau_max)
       def _stepper_unroll(*args, **kwargs):
         return stepper.unroll(*args, **kwargs, num_steps=num_unrolls_per_step)
-      self._apply_operator = jax.checkpoint(_stepper_unroll)
+      self._apply_operator = _stepper_unroll
+    if unroll_direct is None:
+      unroll_direct = (self.num_steps_direct <= UNROLL_MAX_STEPS)
+    self.unroll_direct = unroll_direct
+    self.remat = remat
+
+    # Time differences of the direct predictions and of a jump
+    self._taus_direct = self.dt * np.arange(1, self.num_steps_direct+1)
+    self._tau_jump = self.dt * self.num_steps_direct
+
+    # Compile each rollout as a whole
+    # NOTE: The number of steps determines the shapes and must be static
+    self.unroll = jax.jit(self.unroll, static_argnames=('num_steps',))
+    self.jump = jax.jit(self.jump, static_argnames=('num_jumps',))
+
+  def _remat(self, num_steps: int) -> bool:
+    """Whether to rematerialize the loop body of a rollout of num_steps steps."""
+    if self.remat is None:
+      return (num_steps >= REMAT_MIN_STEPS)
+    return self.remat
 
   def unroll(self,
     variables: flax.typing.VariableDict,
@@ -421,18 +460,26 @@ class AutoregressiveStepper:
       keys = jax.random.split(key, num=_num_direct_steps)
       forcing = jnp.concatenate([tau.reshape(-1, 1), keys], axis=-1)
       _, u_out = jax.lax.scan(f=scan_fn_direct,
-        init=(u_inp, t_inp), xs=forcing, length=_num_direct_steps)
-      u_out = jnp.squeeze(u_out, axis=2).swapaxes(0, 1)
-      u_next = u_out[:, -1:]
-      t_next = t_inp + self.dt * self.num_steps_direct
+        init=(u_inp, t_inp), xs=forcing, length=_num_direct_steps,
+        unroll=(_num_direct_steps if self.unroll_direct else 1))
+      # NOTE: Outputs are kept time-major [num_direct_steps, batch_size, ...]
+      u_out = jnp.squeeze(u_out, axis=2)
+      u_next = jnp.expand_dims(u_out[-1], axis=1)
+      t_next = t_inp + self._tau_jump
       carry = (u_next, t_next)
       return carry, u_out
 
+    # Rematerialize the loop body in the backward pass
+    if self._remat(num_steps):
+      scan_fn_autoregressive = jax.checkpoint(scan_fn_autoregressive)
+
+    # Allocate the time-major rollout with the input as the first time slice
+    rollout = jnp.zeros(shape=(num_steps+1, batch_size, num_pnodes, num_vars), dtype=u_inp.dtype)
+    rollout = rollout.at[0].set(u_inp[:, 0])
+
     # Get full sets of direct predictions
     num_jumps = num_steps // self.num_steps_direct
-    tau_tiled = self.dt * jnp.tile(
-      jnp.arange(1, self.num_steps_direct+1), reps=(num_jumps, 1)
-    ).reshape(num_jumps, self.num_steps_direct)
+    tau_tiled = np.tile(self._taus_direct, reps=(num_jumps, 1))
     key, subkey = jax.random.split(key)
     keys = jax.random.split(subkey, num=num_jumps)
     forcings = jnp.concatenate([tau_tiled, keys], axis=-1)
@@ -442,15 +489,14 @@ class AutoregressiveStepper:
       xs=forcings,
       length=num_jumps,
     )
-    rollout_full = rollout_full.swapaxes(0, 1)
-    rollout_full = rollout_full.reshape(
-      batch_size, (num_jumps*self.num_steps_direct), num_pnodes, num_vars)
-    rollout = jnp.concatenate([u_inp, rollout_full], axis=1)
+    num_steps_full = num_jumps * self.num_steps_direct
+    rollout = rollout.at[1:(num_steps_full+1)].set(
+      rollout_full.reshape(num_steps_full, batch_size, num_pnodes, num_vars))
 
     # Get the last set of direct predictions partially (if necessary)
     num_steps_rem = num_steps % self.num_steps_direct
     if num_steps_rem:
-      tau_tiled = self.dt * jnp.arange(1, num_steps_rem+1).reshape(1, num_steps_rem)
+      tau_tiled = self._taus_direct[:num_steps_rem].reshape(1, num_steps_rem)
       key, subkey = jax.random.split(key, num=2)
       keys = subkey.reshape(1, 2)
       forcings = jnp.concatenate([tau_tiled, keys], axis=-1)
@@ -460,13 +506,10 @@ class AutoregressiveStepper:
         xs=forcings,
         length=1
       )
-      rollout_part = rollout_part.swapaxes(0, 1)
-      rollout_part = rollout_part.reshape(
-        batch_size, num_steps_rem, num_pnodes, num_vars)
-      rollout = jnp.concatenate([rollout, rollout_part], axis=1)
+      rollout = rollout.at[(num_steps_full+1):].set(rollout_part[0])
 
     # Exclude the last timestep because it is returned separately
-    rollout = rollout[:, :-1]
+    rollout = rollout[:-1].swapaxes(0, 1)
 
     return rollout, u_next
 
@@ -490,7 +533,7 @@ class AutoregressiveStepper:
     def scan_fn(carry, forcing):
       u_inp, t_inp = carry
       subkey = forcing if random else None
-      tau = self.dt * self.num_steps_direct
+      tau = self._tau_jump
       _inputs = Inputs(
         u=u_inp,
         c=inputs.c,
@@ -512,6 +555,10 @@ class AutoregressiveStepper:
       rollout = None
       return carry, rollout
 
+    # Rematerialize the loop body in the backward pass
+    if self._remat(num_jumps * self.num_steps_direct):
+      scan_fn = jax.checkpoint(scan_fn)
+
     keys = jax.random.split(key, num=num_jumps)
     forcings = keys
     (u_next, t_next), _ = jax.lax.scan(
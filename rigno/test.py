@@ -4,6 +4,7 @@ import shutil
 from time import time
 from typing import Tuple, Type, Mapping, Callable, Any, Sequence
 
+import flax.typing
 import jax
 import jax.numpy as jnp
 import matplotlib.pyplot as plt
@@ -57,6 +58,9 @@ def define_flags():
   flags.DEFINE_boolean(name='ensemble', default=False, required=False,
     help='If passed, ensemble samples are generated using model randomness'
   )
+  flags.DEFINE_integer(name='seed', default=45, required=False,
+    help='Seed for the random number generator of the noise and ensemble samples'
+  )
 
 def print_between_dashes(msg):
   logging.info('-' * 80)
@@ -149,31 +153,34 @@ def get_direct_estimations(
   tau: float,
   time_downsample_factor: int = 1,  # TMP REMOVE?
   key = None,
+  max_lead_times_per_call: int = 4,
 ) -> Array:
   """Inputs are of shape [batch_size_per_device, ...]"""
 
-  # Set lead times
-  lead_times = jnp.arange(batch.shape[1])
+  # Group the lead times and put each group along the batch axis
+  # NOTE: The group size bounds the memory of one model call
+  # -> [num_groups, group_size * batch_size_per_device, 1, ...]
   batch_size = batch.shape[0]
-
-  # Get inputs for all lead times
-  # -> [num_lead_times, batch_size_per_device, ...]
-  u_inp = jax.vmap(
-      lambda lt: jax.lax.dynamic_slice_in_dim(
-        operand=batch.u,
-        start_index=(lt), slice_size=1, axis=1)
-  )(lead_times)
-  t_inp = batch.t.swapaxes(0, 1).reshape(-1, batch_size, 1)
-
-  # Get model estimations
-  def _use_step_on_mini_batches(carry, x):
-    idx = carry
+  num_lead_times = batch.shape[1]
+  group_size = max(
+    d for d in range(1, min(max_lead_times_per_call, num_lead_times) + 1)
+    if (num_lead_times % d == 0)
+  )
+  num_groups = num_lead_times // group_size
+  _fold = lambda arr: arr.swapaxes(0, 1).reshape(num_groups, group_size * batch_size, 1, *arr.shape[2:])
+  u_inp = _fold(batch.u)
+  c_inp = _fold(batch.c) if (batch.c is not None) else None
+  t_inp = batch.t.swapaxes(0, 1).reshape(num_groups, group_size * batch_size, 1)
+
+  # Get model estimations for one group of lead times at a time
+  def _use_step_on_group(carry, xs):
+    _u_inp, _c_inp, _t_inp = xs
     inputs = Inputs(
-      u=u_inp[idx],
-      c=(batch.c[:, [idx]] if (batch.c is not None) else None),
+      u=_u_inp,
+      c=_c_inp,
       x_inp=batch._x,
       x_out=batch._x,
-      t=(t_inp[idx] / time_downsample_factor),
+      t=(_t_inp / time_downsample_factor),
       tau=tau,
     )
     _u_prd = step(
@@ -183,19 +190,17 @@ def get_direct_estimations(
       graphs=graphs,
       key=key,
     )
-    carry += 1
     return carry, _u_prd
-  # -> [num_lead_times, batch_size_per_device, 1, ...]
+  # -> [num_groups, group_size * batch_size_per_device, 1, ...]
   _, u_prd = jax.lax.scan(
-    f=_use_step_on_mini_batches,
-    init=0,
-    xs=None,
-    length=batch.shape[1],
+    f=_use_step_on_group,
+    init=None,
+    xs=(u_inp, c_inp, t_inp),
   )
 
   # Re-arrange
   # -> [batch_size_per_device, num_lead_times, ...]
-  u_prd = u_prd.swapaxes(0, 1).squeeze(axis=2)
+  u_prd = u_prd.reshape(num_lead_times, batch_size, *u_prd.shape[3:]).swapaxes(0, 1)
 
   return u_prd
 
@@ -231,6 +236,7 @@ def get_all_estimations(
   stats: dict,
   resolution_train: Tuple[int, int],
   train_flags: Mapping,
+  key: flax.typing.PRNGKey,
   taus_direct: Sequence[int] = [],
   taus_rollout: Sequence[int] = [],
   resolutions: Sequence[Tuple[int, int]] = [],
@@ -259,7 +265,7 @@ def get_all_estimations(
 
     # Loop over the batches
     u_prd = []
-    for batch in dataset.batches(mode='test', batch_size=FLAGS.batch_size):
+    for batch in dataset.batches(mode='test', batch_size=FLAGS.batch_size, prefetch=2):
       # Transform the batch
       if transform is not None:
         batch = transform(batch)
@@ -339,8 +345,8 @@ def get_all_estimations(
         tau_max=(tau_max / train_flags['time_downsample_factor']),
         dt=(1. / train_flags['time_downsample_factor'])
       )
-      apply_unroll_jit[resolution][tau_max] = jax.jit(
-        unrollers[resolution][tau_max].unroll, static_argnums=(4,))
+      # NOTE: Already jitted, compiled once per num_steps
+      apply_unroll_jit[resolution][tau_max] = unrollers[resolution][tau_max].unroll
 
   # Set the groundtruth solutions
   u_gtr = next(dataset.batches(mode='test', batch_size=dataset.nums['test']))
@@ -462,11 +468,14 @@ def get_all_estimations(
   tau = train_flags['time_downsample_factor']
   resolution = resolution_train
   for noise_level in noise_levels:
+    key, noise_key = jax.random.split(key)
     # Transformation
     def transform(arr):
+      nonlocal noise_key
+      noise_key, subkey = jax.random.split(noise_key)
       arr = change_resolution(arr, resolution)
       std_arr = np.std(arr, axis=(0, 2, 3), keepdims=True)
-      arr += noise_level * np.random.normal(scale=std_arr, size=arr.shape)
+      arr += noise_level * std_arr * np.asarray(jax.random.normal(subkey, shape=arr.shape, dtype=arr.dtype))
       return arr
     # Direct estimations
     t0 = time()
@@ -540,7 +549,7 @@ def get_ensemble_estimations(
   ):
     # Loop over the batches
     u_prd = []
-    for batch in dataset.batches(mode='test', batch_size=FLAGS.batch_size):
+    for batch in dataset.batches(mode='test', batch_size=FLAGS.batch_size, prefetch=2):
       # Transform the batch
       if transform is not None:
         batch = transform(batch)
@@ -591,8 +600,8 @@ def get_ensemble_estimations(
     tau_max=(tau_max / train_flags['time_downsample_factor']),
     dt=(1. / train_flags['time_downsample_factor'])
   )
-  apply_unroll_jit = jax.jit(
-    unroller.unroll, static_argnums=(4,))
+  # NOTE: Already jitted, compiled once per num_steps
+  apply_unroll_jit = unroller.unroll
 
   # Autoregressive rollout
   u_prd = []
@@ -748,7 +757,11 @@ def main(argv):
   u_gtr = next(dataset.batches(mode='test', batch_size=dataset.nums['test']))
   u_gtr_small = next(dataset_small.batches(mode='test', batch_size=dataset_small.nums['test']))
 
+  # Set the random key
+  key = jax.random.PRNGKey(FLAGS.seed)
+
   # Get model estimations with all settings
+  subkey, key = jax.random.split(key)
   errors, u_prd = get_all_estimations(
     dataset=dataset,
     model=model,
@@ -757,6 +770,7 @@ def main(argv):
     stats=stats,
     resolution_train=resolution_train,
     train_flags=configs['flags'],
+    key=subkey,
     taus_direct=taus_direct,
     taus_rollout=taus_rollout,
     resolutions=space_downsample_factors,
@@ -866,7 +880,6 @@ def main(argv):
   # Get ensemble estimations with the default settings
   # NOTE: One compilation
   if FLAGS.ensemble:
-    key = jax.random.PRNGKey(45)
     subkey, key = jax.random.split(key)
     u_prd_ensemble = get_ensemble_estimations(
       repeats=20,
@@ -1,6 +1,7 @@
 import json
 import pickle
 import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from time import time
 from typing import Tuple, Any, Mapping, Iterable, Callable, Union
@@ -26,12 +27,13 @@ from rigno.metrics import mse_error, rel_lp_error_per_var, rel_lp_error_norm
 from rigno.models.operator import AbstractOperator, Inputs
 from rigno.models.rigno import RIGNO
 from rigno.models.rigno import RegionInteractionGraphBuilder, RegionInteractionGraphs
+from rigno.stepping import Stepper
 from rigno.stepping import AutoregressiveStepper
 from rigno.stepping import TimeDerivativeStepper
 from rigno.stepping import ResidualStepper
 from rigno.stepping import OutputStepper
 from rigno.test import get_direct_estimations
-from rigno.utils import disable_logging, Array, shuffle_arrays, split_arrays, is_multiple
+from rigno.utils import disable_logging, Array, is_multiple
 
 
 NUM_DEVICES = jax.local_device_count()
@@ -154,6 +156,12 @@ def define_flags():
   flags.DEFINE_boolean(name='fractional', default=False, required=False,
     help='If passed, train with fractional time steps (unrolled)'
   )
+  flags.DEFINE_integer(name='grad_accumulation_steps', default=1, lower_bound=1, required=False,
+    help='Number of sub-batch gradients accumulated before each optimizer update'
+  )
+  flags.DEFINE_integer(name='subbatch_factor', default=1, lower_bound=1, required=False,
+    help='Number of input/output pairs per sample in each training sub-batch'
+  )
   flags.DEFINE_integer(name='n_train', default=(2**9), required=False,
     help='Number of training samples'
   )
@@ -198,15 +206,26 @@ def define_flags():
   flags.DEFINE_float(name='p_edge_masking', default=0.5, required=False,
     help='Probability of random edge masking'
   )
+  flags.DEFINE_string(name='compute_dtype', default=None, required=False,
+    help='Dtype of the model computations (e.g., bfloat16), parameters are kept in float32'
+  )
+  flags.DEFINE_string(name='data_dtype', default=None, required=False,
+    help='Dtype of the training data and coordinates (e.g., float32), the dtype of the files by default'
+  )
+  flags.DEFINE_boolean(name='remat_processor', default=False, required=False,
+    help='If passed, rematerializes the processor message-passing steps to save memory'
+  )
 
 def train(
   key: flax.typing.PRNGKey,
-  model: AbstractOperator,
+  stepper: Stepper,
+  autoregressive: Union[None, AutoregressiveStepper],
   state: TrainState,
   dataset: Dataset,
   tau_max: int,
   unroll: bool,
   epochs: int,
+  lr_schedule: optax.Schedule,
   epochs_before: int = 0,
   loss_fn: Callable = mse_loss,
 ) -> TrainState:
@@ -240,19 +259,15 @@ def train(
       num_lead_times_full * tau_max
       + (num_lead_times_part * (num_lead_times_part+1) // 2)
     )
-    lead_times = jnp.arange(num_times - 1)
+    assert FLAGS.subbatch_factor <= num_valid_pairs
+    # Index all valid input/output pairs of a batch
+    # -> [batch_size_per_device * num_valid_pairs]
+    _lt, _d = np.meshgrid(np.arange(num_lead_times), np.arange(1, tau_max + 1), indexing='ij')
+    _is_valid = (_lt + _d) < num_times
+    idx_pairs_b = np.repeat(np.arange(batch_size_per_device), np.sum(_is_valid))
+    idx_pairs_lt = np.tile(_lt[_is_valid], reps=batch_size_per_device)
+    idx_pairs_d = np.tile(_d[_is_valid], reps=batch_size_per_device)
 
-  # Define the steppers
-  if FLAGS.stepper == 'der':
-    stepper = TimeDerivativeStepper(operator=model)
-  elif FLAGS.stepper == 'res':
-    stepper = ResidualStepper(operator=model)
-  elif FLAGS.stepper == 'out':
-    stepper = OutputStepper(operator=model)
-  else:
-    raise ValueError
-  if dataset.time_dependent:
-    autoregressive = AutoregressiveStepper(stepper=stepper, dt=dataset.dt)
   # Define the graph builder
   time_graph_build_compare(dataset,"overlap")
   breakpoint()
@@ -276,27 +291,58 @@ def train(
   )
   print(f"after graph builder, it takes {time() - time_original}")
   # Set the normalization statistics
+  # NOTE: Closed over as constants by the pmapped functions
   stats = {
     key: {
-      k: (jnp.array(v) if (v is not None) else None)
+      k: (np.asarray(v) if (v is not None) else None)
       for k, v in val.items()
     }
     for key, val in dataset.stats.items()
   }
 
-  # Replicate state, stats, and graphs
+  # Count the optimizer steps on host for logging the learning rate
+  # NOTE: The schedule is only advanced once every accumulated update
+  num_steps = int(state.step)
+  num_steps_per_epoch = num_batches * (
+    (num_valid_pairs // FLAGS.subbatch_factor) if dataset.time_dependent else 1)
+  def _get_learning_rate(num_steps: int) -> float:
+    num_updates = num_steps // FLAGS.grad_accumulation_steps
+    return float(lr_schedule(max(num_updates - 1, 0)))
+
+  # Replicate state and graphs
   # NOTE: Internally uses jax.device_put_replicate
   state = replicate(state)
-  stats = replicate(stats)
   graphs = replicate(graphs)
 
-  @functools.partial(jax.pmap, axis_name='device')
+  # Stage the training samples on the devices once
+  # NOTE: They are shuffled on device at every epoch
+  # NOTE: The leading axis of the per-sample arrays is sharded over the local devices
+  # NOTE: Requires device memory for twice the per-sample arrays of the training split
+  sharding = jax.sharding.NamedSharding(
+    jax.sharding.Mesh(jax.local_devices(), axis_names=('device',)),
+    jax.sharding.PartitionSpec('device'),
+  )
+  def _collapse(arr: np.ndarray) -> np.ndarray:
+    # Keep the repeated axes of the coordinates and coefficients with size 1
+    if 0 in arr.strides:
+      arr = arr[tuple((slice(0, 1) if (stride == 0) else slice(None)) for stride in arr.strides)]
+      arr = np.ascontiguousarray(arr)
+    return arr
+  batch_trn = jax.tree_util.tree_map(_collapse, dataset.train(np.arange(num_samples_trn)))
+  # Separate the sample-invariant arrays, they are replicated and never shuffled
+  _is_per_sample = lambda arr: (arr.shape[0] == num_samples_trn)
+  batch_trn_invariant = replicate(jax.tree_util.tree_map(
+    lambda arr: (None if _is_per_sample(arr) else arr), batch_trn))
+  batch_trn = jax.tree_util.tree_map(
+    lambda arr: (jax.device_put(arr, sharding) if _is_per_sample(arr) else None), batch_trn)
+
   def _train_one_batch(
     key: flax.typing.PRNGKey,
     state: TrainState,
     stats: dict,
     graphs: RegionInteractionGraphs,
     batch: Batch,
+    permutation: Union[None, Array] = None,
   ) -> Tuple[TrainState, Array, Array]:
     """Loads a batch, normalizes it, updates the state based on it, and returns it."""
 
@@ -386,6 +432,8 @@ def train(
             graphs=graphs,
             key=subkey,
           )
+          # NOTE: Push-forward, the intermediary output is a constant input of the loss
+          u_int = jax.lax.stop_gradient(u_int)
           c_int = c_inp  # TODO: Approximate c_int
           x_int = x_inp  # TODO: Support variable x
           t_int = t_inp + tau_mid
@@ -425,181 +473,163 @@ def train(
       return state, loss, grads
 
     if dataset.time_dependent:
-      # Index trajectories and times and collect input/output pairs
-      # -> [num_lead_times, batch_size_per_device, ...]
-      u_inp_batch = jax.vmap(
-          lambda lt: jax.lax.dynamic_slice_in_dim(
-            operand=batch.u,
-            start_index=(lt), slice_size=1, axis=1)
-      )(lead_times)
-      c_inp_batch = jax.vmap(
-          lambda lt: jax.lax.dynamic_slice_in_dim(
-            operand=batch.c,
-            start_index=(lt), slice_size=1, axis=1)
-      )(lead_times) if (batch.c is not None) else None
-      x_inp_batch = jax.vmap(
-          lambda lt: jax.lax.dynamic_slice_in_dim(
-            operand=batch.x,
-            start_index=(lt), slice_size=1, axis=1)
-      )(lead_times)
-      t_inp_batch = jax.vmap(
-          lambda lt: jax.lax.dynamic_slice_in_dim(
-            operand=batch.t,
-            start_index=(lt), slice_size=1, axis=1)
-      )(lead_times)
-      u_tgt_batch = jax.vmap(
-          lambda lt: jax.lax.dynamic_slice_in_dim(
-            operand=jnp.concatenate([batch.u, jnp.zeros_like(batch.u)], axis=1),
-            start_index=(lt+1), slice_size=tau_max, axis=1)
-      )(lead_times)
-      t_tgt_batch = jax.vmap(
-          lambda lt: jax.lax.dynamic_slice_in_dim(
-            operand=jnp.concatenate([batch.t, jnp.zeros_like(batch.t)], axis=1),
-            start_index=(lt+1), slice_size=tau_max, axis=1)
-      )(lead_times)
-      x_out_batch = jax.vmap(
-          lambda lt: jax.lax.dynamic_slice_in_dim(
-            operand=jnp.concatenate([batch.x, jnp.zeros_like(batch.x)], axis=1),
-            start_index=(lt+1), slice_size=tau_max, axis=1)
-      )(lead_times)
-
-      # Repeat inputs along the time axis to match with u_tgt
-      # -> [num_lead_times, batch_size_per_device, tau_max, ...]
-      u_inp_batch = jnp.tile(u_inp_batch, reps=(1, 1, tau_max, 1, 1))
-      c_inp_batch = jnp.tile(c_inp_batch, reps=(1, 1, tau_max, 1, 1)) if (batch.c is not None) else None
-      x_inp_batch = jnp.tile(x_inp_batch, reps=(1, 1, tau_max, 1, 1))
-      t_inp_batch = jnp.tile(t_inp_batch, reps=(1, 1, tau_max, 1, 1))
-
-      # Put all pairs along the batch axis
-      # -> [batch_size_per_device * num_lead_times * tau_max, ...]
-      u_inp_batch = u_inp_batch.reshape((num_lead_times*batch_size_per_device*tau_max), 1, num_pnodes, -1)
-      x_inp_batch = x_inp_batch.reshape((num_lead_times*batch_size_per_device*tau_max), 1, num_pnodes, -1)
-      c_inp_batch = c_inp_batch.reshape(
-        (num_lead_times*batch_size_per_device*tau_max), 1, num_pnodes, -1) if (batch.c is not None) else None
-      t_inp_batch = t_inp_batch.reshape((num_lead_times*batch_size_per_device*tau_max), 1, 1, 1)
-      t_tgt_batch = t_tgt_batch.reshape((num_lead_times*batch_size_per_device*tau_max), 1, 1, 1)
-      u_tgt_batch = u_tgt_batch.reshape((num_lead_times*batch_size_per_device*tau_max), 1, num_pnodes, -1)
-      x_out_batch = x_out_batch.reshape((num_lead_times*batch_size_per_device*tau_max), 1, num_pnodes, -1)
-
-      # Get tau as the difference between input and target t
-      tau_batch = t_tgt_batch - t_inp_batch
-
-      # Remove the invalid pairs
-      # -> [batch_size_per_device * num_valid_pairs, ...]
-      offset_full_lead_times = (num_times - tau_max) * tau_max * batch_size_per_device
-      idx_invalid_pairs = np.array([
-        (offset_full_lead_times + (_d * batch_size_per_device + _b) * tau_max - (_n + 1))
-        for _d in range(tau_max - 1)
-        for _b in range(1, batch_size_per_device + 1)
-        for _n in range(_d + 1)
-      ]).astype(int)
-      u_inp_batch = jnp.delete(u_inp_batch, idx_invalid_pairs, axis=0)
-      c_inp_batch = jnp.delete(c_inp_batch, idx_invalid_pairs, axis=0) if (batch.c is not None) else None
-      x_inp_batch = jnp.delete(x_inp_batch, idx_invalid_pairs, axis=0)
-      t_inp_batch = jnp.delete(t_inp_batch, idx_invalid_pairs, axis=0)
-      tau_batch = jnp.delete(tau_batch, idx_invalid_pairs, axis=0)
-      u_tgt_batch = jnp.delete(u_tgt_batch, idx_invalid_pairs, axis=0)
-      x_out_batch = jnp.delete(x_out_batch, idx_invalid_pairs, axis=0)
-
-      # Shuffle and split the pairs
-      # -> [num_valid_pairs, batch_size_per_device, ...]
-      num_valid_pairs = u_tgt_batch.shape[0] // batch_size_per_device
-      key, subkey = jax.random.split(key)
-      if batch.c is None:
-        u_inp_batch, x_inp_batch, t_inp_batch, tau_batch, u_tgt_batch, x_out_batch = shuffle_arrays(
-          subkey, [u_inp_batch, x_inp_batch, t_inp_batch, tau_batch, u_tgt_batch, x_out_batch])
-        u_inp_batch, x_inp_batch, t_inp_batch, tau_batch, u_tgt_batch, x_out_batch = split_arrays(
-          [u_inp_batch, x_inp_batch, t_inp_batch, tau_batch, u_tgt_batch, x_out_batch], size=batch_size_per_device)
-      else:
-        u_inp_batch, c_inp_batch, x_inp_batch, t_inp_batch, tau_batch, u_tgt_batch, x_out_batch = shuffle_arrays(
-          subkey, [u_inp_batch, c_inp_batch, x_inp_batch, t_inp_batch, tau_batch, u_tgt_batch, x_out_batch])
-        u_inp_batch, c_inp_batch, x_inp_batch, t_inp_batch, tau_batch, u_tgt_batch, x_out_batch = split_arrays(
-          [u_inp_batch, c_inp_batch, x_inp_batch, t_inp_batch, tau_batch, u_tgt_batch, x_out_batch], size=batch_size_per_device)
+      # Shuffle the indices of the valid input/output pairs and split them
+      # NOTE: Only the indices are shuffled
+      # NOTE: The remainder pairs are dropped if they don't fill a sub-batch
+      # -> [num_subbatches, subbatch_size]
+      num_subbatches = num_valid_pairs // FLAGS.subbatch_factor
+      subbatch_size = batch_size_per_device * FLAGS.subbatch_factor
+      permutation = permutation[:(num_subbatches * subbatch_size)]
+      idx_b = jnp.asarray(idx_pairs_b)[permutation].reshape(num_subbatches, subbatch_size)
+      idx_lt = jnp.asarray(idx_pairs_lt)[permutation].reshape(num_subbatches, subbatch_size)
+      idx_d = jnp.asarray(idx_pairs_d)[permutation].reshape(num_subbatches, subbatch_size)
+
+      xs = (idx_b, idx_lt, idx_d)
+
+      # Gather the input/output pairs of one sub-batch
+      # NOTE: Only the indices are streamed through the scan, the pairs are gathered per sub-batch
+      # NOTE: Axes of size 1 are repeated, e.g., for sample-invariant coordinates
+      # -> [subbatch_size, 1, ...]
+      def _get_subbatch(idx):
+        _idx_b, _idx_lt, _idx_d = idx
+        _idx = lambda i, size: (i if (size > 1) else jnp.zeros_like(i))
+        _gather = lambda arr, idx_t: jnp.expand_dims(
+          arr[_idx(_idx_b, arr.shape[0]), _idx(idx_t, arr.shape[1])], axis=1)
+        _idx_lt_out = _idx_lt + _idx_d
+        u_inp = _gather(batch.u, _idx_lt)
+        c_inp = _gather(batch.c, _idx_lt) if (batch.c is not None) else None
+        x_inp = _gather(batch.x, _idx_lt)
+        t_inp = _gather(batch.t, _idx_lt)
+        # Get tau as the difference between input and target t
+        tau = _gather(batch.t, _idx_lt_out) - t_inp
+        u_tgt = _gather(batch.u, _idx_lt_out)
+        x_out = _gather(batch.x, _idx_lt_out)
+        return u_inp, c_inp, x_inp, t_inp, tau, u_tgt, x_out
+
     else:
-      num_valid_pairs = 1
+      num_subbatches = 1
+      xs = None
+
       # Prepare time-independent input-output pairs
-      # -> [1, batch_size_per_device, ...]
-      u_inp_batch = jnp.expand_dims(batch.c, axis=0)
-      x_inp_batch = jnp.expand_dims(batch.x, axis=0)
-      c_inp_batch = None
-      t_inp_batch = None
-      tau_batch = None
-      u_tgt_batch = jnp.expand_dims(batch.u, axis=0)
-      x_out_batch = jnp.expand_dims(batch.x, axis=0)
-
-    # Add loss and gradients for each subbatch
-    def _update_state(i, carry):
-      # Update state, loss, and gradients
-      _state, _loss_carried, _grads_carried, _key_carried = carry
+      # NOTE: Repeated axes of the coordinates and coefficients are broadcast to the batch
+      # -> [batch_size_per_device, ...]
+      def _get_subbatch(idx):
+        return jax.tree_util.tree_map(
+          lambda arr: jnp.broadcast_to(arr, (*batch.shape[:2], *arr.shape[2:])),
+          (batch.c, None, batch.x, None, None, batch.u, batch.x),
+        )
+
+    # Update the state with each subbatch and average the gradients of the subbatches
+    def _update_state(carry, idx):
+      _state, _grads_carried, _key_carried = carry
       _key_updated, _subkey = jax.random.split(_key_carried)
+      u_inp, c_inp, x_inp, t_inp, tau, u_tgt, x_out = _get_subbatch(idx)
       _state, _loss_subbatch, _grads_subbatch = _update_state_per_subbatch(
         key=_subkey,
         state=_state,
-        u_inp=u_inp_batch[i],
-        c_inp=(c_inp_batch[i] if (c_inp_batch is not None) else None),
-        x_inp=x_inp_batch[i],
-        t_inp=(t_inp_batch[i] if (t_inp_batch is not None) else None),
-        tau=(tau_batch[i] if (tau_batch is not None) else None),
-        u_tgt=u_tgt_batch[i],
-        x_out=x_out_batch[i],
+        u_inp=u_inp,
+        c_inp=c_inp,
+        x_inp=x_inp,
+        t_inp=t_inp,
+        tau=tau,
+        u_tgt=u_tgt,
+        x_out=x_out,
       )
-      # Update the carried loss and gradients of the subbatch
-      _loss_updated = _loss_carried + _loss_subbatch / num_valid_pairs
       _grads_updated = jax.tree_util.tree_map(
-        lambda g_old, g_new: (g_old + g_new / num_valid_pairs),
+        lambda g_old, g_new: (g_old + g_new / num_subbatches),
         _grads_carried,
         _grads_subbatch,
       )
 
-      return _state, _loss_updated, _grads_updated, _key_updated
+      return (_state, _grads_updated, _key_updated), _loss_subbatch
 
     # Loop over the pairs
-    _init_state = state
-    _init_loss = 0.
     _init_grads = jax.tree_util.tree_map(lambda p: jnp.zeros_like(p), state.params)
     key, _init_key = jax.random.split(key)
-    state, loss, grads, _ = jax.lax.fori_loop(
-      lower=0,
-      upper=num_valid_pairs,
-      body_fun=_update_state,
-      init_val=(_init_state, _init_loss, _init_grads, _init_key)
+    (state, grads, _), losses = jax.lax.scan(
+      f=_update_state,
+      init=(state, _init_grads, _init_key),
+      xs=xs,
+      length=num_subbatches,
     )
+    # Get the magnitude of the averaged gradients
+    grad = jnp.mean(jnp.stack([
+      jnp.mean(jnp.abs(g)) for g in jax.tree_util.tree_leaves(grads)]))
+
+    return state, jnp.mean(losses), grad
+
+  # NOTE: The state and the shuffled batches are not reused after the call
+  @functools.partial(jax.pmap, axis_name='device', donate_argnums=(1, 3))
+  def _train_one_epoch(
+    keys: flax.typing.PRNGKey,
+    state: TrainState,
+    graphs: RegionInteractionGraphs,
+    batches: Batch,
+    invariant: Batch,
+  ) -> Tuple[TrainState, Array, Array]:
+    """Loops over the stacked batches of an epoch and updates the state."""
+
+    # Shuffle the input/output pairs of all batches at once
+    # -> [num_batches, batch_size_per_device * num_valid_pairs]
+    if dataset.time_dependent:
+      keys, subkeys = jnp.moveaxis(jax.vmap(jax.random.split)(keys), 1, 0)
+      permutations = jax.vmap(
+        lambda k: jax.random.permutation(k, idx_pairs_b.shape[0]))(subkeys)
+    else:
+      permutations = None
+
+    def _scan_fn(state, inputs):
+      key, batch, permutation = inputs
+      # Put back the sample-invariant arrays
+      batch = Batch(*[(b if (b is not None) else i) for b, i in zip(batch, invariant)])
+      state, loss, grad = _train_one_batch(key, state, stats, graphs, batch, permutation)
+      return state, (loss, grad)
+
+    state, (losses, grads) = jax.lax.scan(
+      f=_scan_fn,
+      init=state,
+      xs=(keys, batches, permutations),
+    )
+
+    return state, jnp.mean(losses), jnp.mean(grads)
 
-    return state, loss, grads
+  # NOTE: The batches of each device are laid out on that device, as expected by pmap
+  @functools.partial(jax.jit, out_shardings=sharding)
+  def _shuffle_and_split(key: flax.typing.PRNGKey, batch: Batch) -> Batch:
+    """Shuffles the samples and splits them in batches for each device."""
+
+    # NOTE: Only the per-sample arrays are passed and copied
+    # -> [NUM_DEVICES, num_batches, batch_size_per_device, ...]
+    permutation = jax.random.permutation(key, num_samples_trn)
+    return jax.tree_util.tree_map(
+      lambda arr: arr[permutation].reshape(
+        num_batches, NUM_DEVICES, batch_size_per_device, *arr.shape[1:]).swapaxes(0, 1),
+      batch,
+    )
 
   def train_one_epoch(
     key: flax.typing.PRNGKey,
     state: TrainState,
-    batches: Iterable[Batch],
   ) -> Tuple[TrainState, Array, Array]:
     """Updates the state based on accumulated losses and gradients."""
 
-    # Loop over the batches
-    loss_epoch = 0.
-    grad_epoch = 0.
-    for batch in batches:
+    # Shuffle the staged training samples on device and split them in batches
+    # -> [NUM_DEVICES, num_batches, batch_size_per_device, ...]
+    key, subkey = jax.random.split(key)
+    batches = _shuffle_and_split(subkey, batch_trn)
 
-      # Split the batch between devices
-      # -> [NUM_DEVICES, batch_size_per_device, ...]
-      batch = Batch(
-        u=shard(batch.u),
-        c=shard(batch.c),
-        x=shard(batch.x),
-        t=shard(batch.t),
-      )
+    # Get one key per batch and device
+    # -> [NUM_DEVICES, num_batches, 2]
+    keys = jax.vmap(shard_prng_key)(jax.random.split(key, num=num_batches)).swapaxes(0, 1)
 
-      # Get loss and updated state
-      subkey, key = jax.random.split(key)
-      subkey = shard_prng_key(subkey)
-      state, loss, grads = _train_one_batch(subkey, state, stats, graphs, batch)
-      # NOTE: Using the first element of replicated loss and grads
-      loss_epoch += loss[0] * FLAGS.batch_size / num_samples_trn
-      grad_epoch += np.mean(jax.tree_util.tree_flatten(
-        jax.tree_util.tree_map(jnp.mean, jax.tree_util.tree_map(lambda g: jnp.abs(g[0]), grads)))[0]) / num_batches
+    # Get loss and updated state
+    state, loss, grad = _train_one_epoch(keys, state, graphs, batches, batch_trn_invariant)
+    # NOTE: Using the first element of replicated loss and grads
+    loss_epoch = loss[0]
+    grad_epoch = grad[0]
 
     return state, loss_epoch, grad_epoch
 
-  @functools.partial(jax.pmap, static_broadcasted_argnums=(0,))
   def _evaluate_direct_prediction(
     tau_ratio: Union[None, float, int],
     state: TrainState,
@@ -637,7 +667,6 @@ def train(
 
     return batch_metrics.__dict__
 
-  @jax.pmap
   def _evaluate_rollout_prediction(
     state: TrainState,
     stats,
@@ -681,7 +710,6 @@ def train(
 
     return batch_metrics.__dict__
 
-  @jax.pmap
   def _evaluate_final_prediction(
     state: TrainState,
     stats,
@@ -719,7 +747,7 @@ def train(
         _num_dt_jumped = _num_jumps * _predictor.num_steps_direct
         inputs = Inputs(
           u=u_prd,
-          c=(batch.c[:, [_num_dt_jumped]] if (batch.c is not None) else None),
+          c=(batch.c[:, _num_dt_jumped:(_num_dt_jumped+1)] if (batch.c is not None) else None),
           x_inp=batch._x,
           x_out=batch._x,
           t=(batch.t[:, :1] + _num_dt_jumped * _predictor.dt),
@@ -734,12 +762,12 @@ def train(
         )
 
     else:
-      u_tgt = batch.u[:, [0]]
+      u_tgt = batch.u[:, :1]
       u_prd = stepper.apply(
         variables={'params': state.params},
         stats=stats,
         inputs=Inputs(
-          u=batch.c[:, [0]],
+          u=batch.c[:, :1],
           c=None,
           x_inp=batch._x,
           x_out=batch._x,
@@ -758,20 +786,44 @@ def train(
 
     return batch_metrics.__dict__
 
-  def evaluate(
+  @functools.partial(jax.pmap, static_broadcasted_argnums=(0, 1, 2))
+  def _evaluate_batch(
+    direct: bool,
+    rollout: bool,
+    final: bool,
+    state: TrainState,
+    graphs: RegionInteractionGraphs,
+    batch: Batch,
+  ) -> Mapping:
+    """Runs all the requested evaluations of a batch in a single call."""
+
+    metrics = {}
+    if direct:
+      metrics['direct_tau_frac'] = _evaluate_direct_prediction(.5, state, stats, graphs, batch)
+      metrics['direct_tau_min'] = _evaluate_direct_prediction(1, state, stats, graphs, batch)
+      metrics['direct_tau_max'] = _evaluate_direct_prediction(FLAGS.tau_max, state, stats, graphs, batch)
+    if rollout:
+      metrics['rollout'] = _evaluate_rollout_prediction(state, stats, graphs, batch)
+    if final:
+      metrics['final'] = _evaluate_final_prediction(state, stats, graphs, batch)
+
+    return metrics
+
+  def dispatch_evaluation(
     state: TrainState,
     batches: Iterable[Batch],
     direct: bool = True,
     rollout: bool = False,
     final: bool = True,
-  ) -> EvalMetrics:
-    """Evaluates the model on a dataset based on multiple trajectory lengths."""
+  ) -> Mapping:
+    """
+    Launches the evaluations of the model on a dataset based on multiple trajectory lengths.
+    Returns the aggregated metrics as device arrays, without waiting for them.
+    """
 
-    metrics_direct_tau_frac: list[BatchMetrics] = []
-    metrics_direct_tau_min: list[BatchMetrics] = []
-    metrics_direct_tau_max: list[BatchMetrics] = []
-    metrics_rollout: list[BatchMetrics] = []
-    metrics_final: list[BatchMetrics] = []
+    metrics_batches: Mapping[str, list[BatchMetrics]] = {
+      key: [] for key in ['direct_tau_frac', 'direct_tau_min', 'direct_tau_max', 'rollout', 'final']
+    }
 
     # Turn off unrelevent evaluations
     if not dataset.time_dependent:
@@ -787,98 +839,56 @@ def train(
         x=shard(batch.x),
         t=shard(batch.t),
       )
+      if final and dataset.time_dependent:
+        assert (IDX_FN // FLAGS.time_downsample_factor) < batch.u.shape[2]
 
-      # Evaluate direct prediction
-      if direct:
-        # tau = .5*dt
-        batch_metrics_direct_tau_frac = _evaluate_direct_prediction(.5, state, stats, graphs, batch)
-        batch_metrics_direct_tau_frac = BatchMetrics(**batch_metrics_direct_tau_frac)
+      # Evaluate all the requested predictions at once
+      batch_metrics = _evaluate_batch(direct, rollout, final, state, graphs, batch)
+      for key, val in batch_metrics.items():
+        val = BatchMetrics(**val)
         # Re-arrange the sub-batches gotten from each device
-        batch_metrics_direct_tau_frac.reshape(shape=(batch_size_per_device * NUM_DEVICES, 1))
+        val.reshape(shape=(batch_size_per_device * NUM_DEVICES, 1))
         # Append the metrics to the list
-        metrics_direct_tau_frac.append(batch_metrics_direct_tau_frac)
+        metrics_batches[key].append(val)
+
+    # Aggregate over the batch dimension on device
+    def _aggregate(metrics: list[BatchMetrics]) -> Mapping:
+      return {
+        key: jnp.median(jnp.concatenate([m.__getattribute__(key) for m in metrics]), axis=0)
+        for key in ['mse', 'l1', 'l2']
+      }
+    aggregated = {
+      key: (_aggregate(val) if val else None)
+      for key, val in metrics_batches.items()
+    }
 
-        # tau = dt
-        batch_metrics_direct_tau_min = _evaluate_direct_prediction(1, state, stats, graphs, batch)
-        batch_metrics_direct_tau_min = BatchMetrics(**batch_metrics_direct_tau_min)
-        # Re-arrange the sub-batches gotten from each device
-        batch_metrics_direct_tau_min.reshape(shape=(batch_size_per_device * NUM_DEVICES, 1))
-        # Append the metrics to the list
-        metrics_direct_tau_min.append(batch_metrics_direct_tau_min)
+    return aggregated
 
-        # tau = tau_max
-        batch_metrics_direct_tau_max = _evaluate_direct_prediction(FLAGS.tau_max, state, stats, graphs, batch)
-        batch_metrics_direct_tau_max = BatchMetrics(**batch_metrics_direct_tau_max)
-        # Re-arrange the sub-batches gotten from each device
-        batch_metrics_direct_tau_max.reshape(shape=(batch_size_per_device * NUM_DEVICES, 1))
-        # Append the metrics to the list
-        metrics_direct_tau_max.append(batch_metrics_direct_tau_max)
+  def fetch_evaluation(aggregated: Mapping) -> EvalMetrics:
+    """Waits for dispatched evaluations and builds the metrics object."""
 
-      # Evaluate rollout prediction
-      if rollout:
-        batch_metrics_rollout = _evaluate_rollout_prediction(state, stats, graphs, batch)
-        batch_metrics_rollout = BatchMetrics(**batch_metrics_rollout)
-        # Re-arrange the sub-batches gotten from each device
-        batch_metrics_rollout.reshape(shape=(batch_size_per_device * NUM_DEVICES, 1))
-        # Compute and store metrics
-        metrics_rollout.append(batch_metrics_rollout)
-
-      # Evaluate final prediction
-      if final:
-        if dataset.time_dependent: assert (IDX_FN // FLAGS.time_downsample_factor) < batch.u.shape[2]
-        batch_metrics_final = _evaluate_final_prediction(state, stats, graphs, batch)
-        batch_metrics_final = BatchMetrics(**batch_metrics_final)
-        # Re-arrange the sub-batches gotten from each device
-        batch_metrics_final.reshape(shape=(batch_size_per_device * NUM_DEVICES, 1))
-        # Append the errors to the list
-        metrics_final.append(batch_metrics_final)
-
-    # Aggregate over the batch dimension and compute norm per variable
-    metrics_direct_tau_frac = Metrics(
-      mse=jnp.median(jnp.concatenate([m.mse for m in metrics_direct_tau_frac]), axis=0).item(),
-      l1=jnp.median(jnp.concatenate([m.l1 for m in metrics_direct_tau_frac]), axis=0).item(),
-      l2=jnp.median(jnp.concatenate([m.l2 for m in metrics_direct_tau_frac]), axis=0).item(),
-    ) if direct else None
-    metrics_direct_tau_min = Metrics(
-      mse=jnp.median(jnp.concatenate([m.mse for m in metrics_direct_tau_min]), axis=0).item(),
-      l1=jnp.median(jnp.concatenate([m.l1 for m in metrics_direct_tau_min]), axis=0).item(),
-      l2=jnp.median(jnp.concatenate([m.l2 for m in metrics_direct_tau_min]), axis=0).item(),
-    ) if direct else None
-    metrics_direct_tau_max = Metrics(
-      mse=jnp.median(jnp.concatenate([m.mse for m in metrics_direct_tau_max]), axis=0).item(),
-      l1=jnp.median(jnp.concatenate([m.l1 for m in metrics_direct_tau_max]), axis=0).item(),
-      l2=jnp.median(jnp.concatenate([m.l2 for m in metrics_direct_tau_max]), axis=0).item(),
-    ) if direct else None
-    metrics_rollout = Metrics(
-      mse=jnp.median(jnp.concatenate([m.mse for m in metrics_rollout]), axis=0).item(),
-      l1=jnp.median(jnp.concatenate([m.l1 for m in metrics_rollout]), axis=0).item(),
-      l2=jnp.median(jnp.concatenate([m.l2 for m in metrics_rollout]), axis=0).item(),
-    ) if rollout else None
-    metrics_final = Metrics(
-      mse=jnp.median(jnp.concatenate([m.mse for m in metrics_final]), axis=0).item(),
-      l1=jnp.median(jnp.concatenate([m.l1 for m in metrics_final]), axis=0).item(),
-      l2=jnp.median(jnp.concatenate([m.l2 for m in metrics_final]), axis=0).item(),
-    ) if final else None
-
-    # Build the metrics object
-    metrics = EvalMetrics(
-      direct_tau_frac=(metrics_direct_tau_frac if direct else Metrics()),
-      direct_tau_min=(metrics_direct_tau_min if direct else Metrics()),
-      direct_tau_max=(metrics_direct_tau_max if direct else Metrics()),
-      rollout=(metrics_rollout if rollout else Metrics()),
-      final=(metrics_final if final else Metrics()),
-    )
+    # NOTE: Single transfer of all the aggregated metrics
+    aggregated = jax.device_get(aggregated)
+    metrics = EvalMetrics(**{
+      key: (Metrics(**{k: v.item() for k, v in val.items()}) if (val is not None) else Metrics())
+      for key, val in aggregated.items()
+    })
 
     return metrics
 
+  def evaluate(state: TrainState, batches: Iterable[Batch], **kwargs) -> EvalMetrics:
+    """Evaluates the model on a dataset based on multiple trajectory lengths."""
+
+    return fetch_evaluation(dispatch_evaluation(state, batches, **kwargs))
+
   # Evaluate before training
   metrics_trn = evaluate(
     state=state,
-    batches=dataset.batches(mode='train', batch_size=FLAGS.batch_size),
+    batches=dataset.batches(mode='train', batch_size=FLAGS.batch_size, prefetch=2),
   )
   metrics_val = evaluate(
     state=state,
-    batches=dataset.batches(mode='valid', batch_size=FLAGS.batch_size),
+    batches=dataset.batches(mode='valid', batch_size=FLAGS.batch_size, prefetch=2),
   )
 
   # Report the initial evaluations
@@ -886,7 +896,7 @@ def train(
   logging.info('\t'.join([
     f'DRCT: {tau_max : 02d}',
     f'EPCH: {epochs_before : 04d}/{FLAGS.epochs : 04d}',
-    f'LR: {state.opt_state[-1].hyperparams["learning_rate"][0].item() : .2e}',
+    f'LR: {_get_learning_rate(num_steps) : .2e}',
     f'TIME: {time_tot_pre : 06.1f}s',
     f'GRAD: {0. : .2e}',
     f'LOSS: {0. : .2e}',
@@ -902,7 +912,8 @@ def train(
   DIR = DIR_EXPERIMENTS / f'E{FLAGS.exp}' / FLAGS.datapath / FLAGS.datetime
   with disable_logging(level=logging.FATAL):
     (DIR / 'metrics').mkdir(exist_ok=True)
-    checkpointer = orbax.checkpoint.PyTreeCheckpointer()
+    # NOTE: Checkpoints are written in the background
+    checkpointer = orbax.checkpoint.AsyncCheckpointer(orbax.checkpoint.PyTreeCheckpointHandler())
     checkpointer_options = orbax.checkpoint.CheckpointManagerOptions(
       max_to_keep=1,
       keep_period=None,
@@ -912,39 +923,39 @@ def train(
     checkpointer_save_args = orbax_utils.save_args_from_target(target={'state': state})
     checkpoint_manager = orbax.checkpoint.CheckpointManager(
       (DIR / 'checkpoints'), checkpointer, checkpointer_options)
+  # NOTE: Metrics are written in the background
+  metrics_writer = ThreadPoolExecutor(max_workers=1)
+  def _write_metrics(path, metrics):
+    with open(path, 'w') as f:
+      json.dump(metrics, f)
 
-  for epoch in range(1, epochs+1):
-    # Store the initial time
-    time_int = time()
+  def report(
+    epoch: int,
+    lr: float,
+    logged: Tuple[Array, Array],
+    aggregated: Union[None, Tuple[Mapping, Mapping]],
+    state_ckpt: Union[None, TrainState],
+  ) -> None:
+    """Fetches the results of an epoch, logs them, and stores the checkpoint."""
 
-    # Train one epoch
-    subkey_0, subkey_1, key = jax.random.split(key, num=3)
-    state, loss, grad = train_one_epoch(
-      key=subkey_1,
-      state=state,
-      batches=dataset.batches(mode='train', batch_size=FLAGS.batch_size, key=subkey_0),
-    )
+    nonlocal time_fetched
 
-    if (epoch % evaluation_frequency) == 0:
-      # Evaluate
-      metrics_trn = evaluate(
-        state=state,
-        batches=dataset.batches(mode='train', batch_size=FLAGS.batch_size),
-      )
-      metrics_val = evaluate(
-        state=state,
-        batches=dataset.batches(mode='valid', batch_size=FLAGS.batch_size),
-      )
+    # NOTE: Single transfer of all the logged values of the epoch
+    grad, loss = map(float, jax.device_get(logged))
+
+    if aggregated is not None:
+      metrics_trn, metrics_val = map(fetch_evaluation, aggregated)
 
       # Log the results
-      time_tot = time() - time_int
+      time_tot = time() - time_fetched
+      time_fetched += time_tot
       logging.info('\t'.join([
         f'DRCT: {tau_max : 02d}',
         f'EPCH: {epochs_before + epoch : 04d}/{FLAGS.epochs : 04d}',
-        f'LR: {state.opt_state[-1].hyperparams["learning_rate"][0].item() : .2e}',
+        f'LR: {lr : .2e}',
         f'TIME: {time_tot : 06.1f}s',
-        f'GRAD: {grad.item() : .2e}',
-        f'LOSS: {loss.item() : .2e}',
+        f'GRAD: {grad : .2e}',
+        f'LOSS: {loss : .2e}',
         f'DR-0.5: {metrics_val.direct_tau_frac.l1 : .2%}' if metrics_val.direct_tau_frac.l1 else '',
         f'DR-1: {metrics_val.direct_tau_min.l1 : .2%}' if metrics_val.direct_tau_min.l1 else '',
         f'DR-{FLAGS.tau_max}: {metrics_val.direct_tau_max.l1 : .2%}' if metrics_val.direct_tau_max.l1 else '',
@@ -955,7 +966,7 @@ def train(
 
       with disable_logging(level=logging.FATAL):
         checkpoint_metrics = {
-          'loss': loss.item(),
+          'loss': loss,
           'train': metrics_trn.to_dict(),
           'valid': metrics_val.to_dict(),
         }
@@ -963,27 +974,103 @@ def train(
         step = epochs_before + epoch
         checkpoint_manager.save(
           step=step,
-          items={'state': jax.device_get(unreplicate(state)),},
+          # NOTE: The device arrays are copied to host by the async checkpointer
+          items={'state': state_ckpt,},
           metrics=checkpoint_metrics,
           save_kwargs={'save_args': checkpointer_save_args}
         )
-        with open(DIR / 'metrics' / f'{str(step)}.json', 'w') as f:
-          json.dump(checkpoint_metrics, f)
+        metrics_writer.submit(_write_metrics, (DIR / 'metrics' / f'{str(step)}.json'), checkpoint_metrics)
 
     else:
       # Log the results
-      time_tot = time() - time_int
+      time_tot = time() - time_fetched
+      time_fetched += time_tot
       logging.info('\t'.join([
         f'DRCT: {tau_max : 02d}',
         f'EPCH: {epochs_before + epoch : 04d}/{FLAGS.epochs : 04d}',
-        f'LR: {state.opt_state[-1].hyperparams["learning_rate"][0].item() : .2e}',
+        f'LR: {lr : .2e}',
         f'TIME: {time_tot : 06.1f}s',
-        f'GRAD: {grad.item() : .2e}',
-        f'LOSS: {loss.item() : .2e}',
+        f'GRAD: {grad : .2e}',
+        f'LOSS: {loss : .2e}',
       ]))
 
+  # NOTE: The results of each epoch are reported after the next epoch is dispatched
+  # NOTE: The logged time of an epoch is measured between the fetches of consecutive results,
+  # so the host-side dispatch of the next epoch is not attributed to a single epoch
+  pending = None
+  time_fetched = time()
+  try:
+    for epoch in range(1, epochs+1):
+      # Train one epoch
+      subkey, key = jax.random.split(key)
+      state, loss, grad = train_one_epoch(
+        key=subkey,
+        state=state,
+      )
+      num_steps += num_steps_per_epoch
+      lr = _get_learning_rate(num_steps)
+      logged = (grad, loss)
+
+      # Launch the evaluations without waiting for them
+      if (epoch % evaluation_frequency) == 0:
+        aggregated = (
+          dispatch_evaluation(
+            state=state,
+            batches=dataset.batches(mode='train', batch_size=FLAGS.batch_size, prefetch=2),
+          ),
+          dispatch_evaluation(
+            state=state,
+            batches=dataset.batches(mode='valid', batch_size=FLAGS.batch_size, prefetch=2),
+          ),
+        )
+        # NOTE: Copied because the unreplicated arrays may alias the buffers that the next epoch donates
+        state_ckpt = jax.tree_util.tree_map(jnp.copy, unreplicate(state))
+      else:
+        aggregated = None
+        state_ckpt = None
+
+      # Report the previous epoch while this one runs on the devices
+      # NOTE: Swapped first so that a failing report is not repeated when exiting
+      _pending, pending = pending, (epoch, lr, logged, aggregated, state_ckpt)
+      if _pending is not None:
+        report(*_pending)
+
+  finally:
+    try:
+      # Report the last epoch
+      if pending is not None:
+        report(*pending)
+    finally:
+      # Wait for the pending checkpoints and metrics
+      checkpoint_manager.wait_until_finished()
+      metrics_writer.shutdown(wait=True)
+
   return unreplicate(state)
 
+def get_steppers(
+  model: AbstractOperator,
+  dataset: Dataset,
+) -> Tuple[Stepper, Union[None, AutoregressiveStepper]]:
+  """
+  Build the steppers of the model once for all training phases.
+  """
+
+  if FLAGS.stepper == 'der':
+    stepper = TimeDerivativeStepper(operator=model)
+  elif FLAGS.stepper == 'res':
+    stepper = ResidualStepper(operator=model)
+  elif FLAGS.stepper == 'out':
+    stepper = OutputStepper(operator=model)
+  else:
+    raise ValueError
+  if dataset.time_dependent:
+    # NOTE: Its jitted unroll and jump are reused by all training phases
+    autoregressive = AutoregressiveStepper(stepper=stepper, dt=dataset.dt)
+  else:
+    autoregressive = None
+
+  return stepper, autoregressive
+
 def get_model(model_configs: Mapping[str, Any], dataset: Dataset) -> AbstractOperator:
   """
   Build the model based on the given configurations.
@@ -1003,6 +1090,8 @@ def get_model(model_configs: Mapping[str, Any], dataset: Dataset) -> AbstractOpe
       conditioned_normalization=(True if dataset.time_dependent else False),
       cond_norm_hidden_size=16,
       p_edge_masking=FLAGS.p_edge_masking,
+      remat_processor=FLAGS.remat_processor,
+      compute_dtype=FLAGS.compute_dtype,
     )
 
   model = RIGNO(**model_configs)
@@ -1014,6 +1103,11 @@ def main(argv):
   if len(argv) > 1:
     raise app.UsageError('Too many command-line arguments.')
 
+  # Cache the compiled XLA programs across runs
+  jax.config.update('jax_compilation_cache_dir', str(DIR_EXPERIMENTS / '.xla_cache'))
+  jax.config.update('jax_persistent_cache_min_entry_size_bytes', 0)
+  jax.config.update('jax_persistent_cache_min_compile_time_secs', 0)
+
   # Check the available devices
   with disable_logging():
     process_index = jax.process_index()
@@ -1046,6 +1140,7 @@ def main(argv):
     n_valid=FLAGS.n_valid,
     n_test=FLAGS.n_test,
     preload=True,
+    dtype=(np.dtype(FLAGS.data_dtype) if FLAGS.data_dtype else None),
     key=subkey,
   )
   if dataset.time_dependent:
@@ -1139,13 +1234,13 @@ def main(argv):
         tau=None,
       )
     subkey, key = jax.random.split(key)
-    variables = jax.jit(model.init)(subkey, inputs=dummy_inputs, graphs=dummy_graphs)
+    # NOTE: Not jitted, the compilation would only be used once
+    variables = model.init(subkey, inputs=dummy_inputs, graphs=dummy_graphs)
     params = variables['params']
 
   # Calculate the total number of parameters
-  n_model_parameters = np.sum(
-    jax.tree_util.tree_flatten(jax.tree_util.tree_map(lambda x: np.prod(x.shape).item(), params))[0]
-  ).item()
+  # NOTE: Only reads the known shapes, no device round-trip
+  n_model_parameters = sum(x.size for x in jax.tree_util.tree_leaves(params))
   logging.info(f'Training a {model.__class__.__name__} with {n_model_parameters} parameters')
 
   # Set transition steps
@@ -1166,9 +1261,11 @@ def main(argv):
         epochs_d = (epochs_dff if (_d == FLAGS.tau_max) else epochs_dxx)
       else:
         epochs_d = FLAGS.epochs
-      transition_steps +=  epochs_d * num_batches * num_valid_pairs_d
+      transition_steps +=  epochs_d * num_batches * (num_valid_pairs_d // FLAGS.subbatch_factor)
   else:
     transition_steps = FLAGS.epochs * num_batches
+  # NOTE: The schedule is only advanced once every accumulated update
+  transition_steps = transition_steps // FLAGS.grad_accumulation_steps
 
   # Set learning rate and optimizer
   pct_start = .02  # Warmup cosine onecycle
@@ -1193,8 +1290,14 @@ def main(argv):
   tx = optax.chain(
     optax.inject_hyperparams(optax.adamw)(learning_rate=lr, weight_decay=1e-08),
   )
+  if FLAGS.grad_accumulation_steps > 1:
+    # NOTE: Gradients are accumulated over sub-batches instead of a larger batch in memory
+    tx = optax.MultiSteps(tx, every_k_schedule=FLAGS.grad_accumulation_steps)
   state = TrainState.create(apply_fn=model.apply, params=params, tx=tx)
 
+  # Define the steppers
+  stepper, autoregressive = get_steppers(model, dataset)
+
   # Train the model
   epochs_trained = 0
 
@@ -1204,12 +1307,14 @@ def main(argv):
       key, subkey = jax.random.split(key)
       state = train(
         key=subkey,
-        model=model,
+        stepper=stepper,
+        autoregressive=autoregressive,
         state=state,
         dataset=dataset,
         tau_max=_d,
         unroll=False,
         epochs=epochs_dxx,
+        lr_schedule=lr,
         epochs_before=epochs_trained,
       )
       epochs_trained += epochs_dxx
@@ -1226,12 +1331,14 @@ def main(argv):
     # Train without unrolling
     state = train(
       key=subkey,
-      model=model,
+      stepper=stepper,
+      autoregressive=autoregressive,
       state=state,
       dataset=dataset,
       tau_max=FLAGS.tau_max,
       unroll=False,
       epochs=epochs_without_unrolling,
+      lr_schedule=lr,
       epochs_before=epochs_trained,
     )
     epochs_trained += epochs_without_unrolling
@@ -1241,12 +1348,14 @@ def main(argv):
     logging.info('-' * 80)
     state = train(
       key=subkey,
-      model=model,
+      stepper=stepper,
+      autoregressive=autoregressive,
       state=state,
       dataset=dataset,
       tau_max=FLAGS.tau_max,
       unroll=True,
       epochs=epochs_with_unrolling,
+      lr_schedule=lr,
       epochs_before=epochs_trained,
     )
     epochs_trained += epochs_with_unrolling
@@ -1254,12 +1363,14 @@ def main(argv):
     # Train without unrolling
     state = train(
       key=subkey,
-      model=model,
+      stepper=stepper,
+      autoregressive=autoregressive,
       state=state,
       dataset=dataset,
       tau_max=FLAGS.tau_max,
       unroll=False,
       epochs=epochs_rest,
+      lr_schedule=lr,
       epochs_before=epochs_trained,
     )
     epochs_trained += epochs_rest